@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import os
+import re
+from typing import Any, Dict, List, Tuple
+
+from .rules import query_terms
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1024"))
+PROMPT_MAX_DISTANCE = float(os.getenv("PROMPT_MAX_DISTANCE", "0.75"))
+
+_FENCE_RE = re.compile(r"^(```|~~~)")
+# Query words are matched as prefixes of this length ("rotate" -> "rotat").
+_STEM_CHARS = 5
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 chars per token for English/BPE models)."""
+    if not text:
+        return 0
+    return (len(text) + 3) // 4
+
+
+def _split_passages(text: str) -> List[str]:
+    """Split a section into blank-line separated passages, keeping code fences whole."""
+    passages: List[str] = []
+    current: List[str] = []
+    in_code_block = False
+    for line in text.splitlines():
+        if _FENCE_RE.match(line.strip()):
+            in_code_block = not in_code_block
+            current.append(line)
+            continue
+        if not in_code_block and not line.strip():
+            if current:
+                passages.append("\n".join(current))
+                current = []
+            continue
+        current.append(line)
+    if current:
+        passages.append("\n".join(current))
+    return passages
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    # Prefer ending on a line or word boundary.
+    for sep in ("\n", " "):
+        idx = cut.rfind(sep)
+        if idx > max_chars // 2:
+            cut = cut[:idx]
+            break
+    return cut.rstrip() + " ..."
+
+
+def _passage_terms(query: str) -> List[str]:
+    """Query words to look for in passages, as prefixes.
+
+    Looser than the low-coverage check: 3-letter words count ("TLS", "JWT")
+    and words are cut to a short stem so "rotate" also finds "rotation".
+    """
+    return sorted({t[:_STEM_CHARS] for t in query_terms(query, min_len=3)})
+
+
+def _score_passage(passage: str, terms: List[str]) -> int:
+    lowered = passage.lower()
+    return sum(1 for t in terms if re.search(rf"\b{re.escape(t)}", lowered))
+
+
+def _trim_section(text: str, terms: List[str], budget: int) -> str:
+    """Fit a section into ``budget``: whole if it fits, else best-matching passages first.
+
+    Passages that match the query go in by score; what budget is left is
+    filled with the other passages in document order. The result keeps
+    document order.
+    """
+    if estimate_tokens(text) <= budget:
+        return text
+    passages = _split_passages(text)
+    if not passages:
+        return ""
+    # The ingest "Section: <heading path>" line is cheap and tells the model where we are.
+    header = ""
+    if passages[0].startswith("Section: "):
+        header = passages.pop(0)
+        budget -= estimate_tokens(header)
+    if budget <= 0 or not passages:
+        return header
+
+    scored = [(_score_passage(p, terms), idx) for idx, p in enumerate(passages)]
+    ranked = sorted([s for s in scored if s[0] > 0], key=lambda s: (-s[0], s[1]))
+    ranked += [s for s in scored if s[0] == 0]
+
+    chosen: Dict[int, str] = {}
+    remaining = budget
+    for _, idx in ranked:
+        cost = estimate_tokens(passages[idx]) + 1  # + the blank line joining passages
+        if cost <= remaining:
+            chosen[idx] = passages[idx]
+            remaining -= cost
+        elif not chosen:
+            chosen[idx] = _truncate_to_tokens(passages[idx], remaining - 1)
+            remaining = 0
+        if remaining <= 0:
+            break
+
+    body = "\n\n".join(chosen[idx] for idx in sorted(chosen))
+    return f"{header}\n\n{body}" if header else body
+
+
+def _shares(costs: List[int], budget: int) -> List[int]:
+    """Per-hit token budgets: hits under an even share keep all they need, larger ones split the rest."""
+    shares = [0] * len(costs)
+    remaining = budget
+    order = sorted(range(len(costs)), key=lambda i: costs[i])
+    for pos, i in enumerate(order):
+        shares[i] = min(costs[i], remaining // (len(costs) - pos))
+        remaining -= shares[i]
+    return shares
+
+
+def pack_context(
+    query: str,
+    hits: List[Dict[str, Any]],
+    token_budget: int = PROMPT_TOKEN_BUDGET,
+    max_distance: float = PROMPT_MAX_DISTANCE,
+) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """Select and trim hits so the prompt context fits ``token_budget``.
+
+    Closer hits are packed first, hits above ``max_distance`` are dropped
+    (the closest hit is always kept so the model has something to work
+    with). Sections that fit their share of the budget are kept whole;
+    larger ones keep the passages that mention the query terms first and
+    fill the rest in document order. Returns the packed hits (same shape as the input, with
+    trimmed ``text``) and token stats for metrics.
+    """
+    original_tokens = sum(estimate_tokens(h.get("text") or "") for h in hits)
+    ordered = sorted(hits, key=lambda h: float(h.get("distance", 0.0)))
+    eligible = [h for h in ordered if float(h.get("distance", 0.0)) <= max_distance]
+    if not eligible and ordered:
+        eligible = ordered[:1]
+
+    terms = _passage_terms(query)
+    # Sections are only trimmed when they are over their share of the budget.
+    shares = _shares([estimate_tokens(h.get("text") or "") for h in eligible], token_budget)
+    packed: List[Dict[str, Any]] = []
+    remaining = token_budget
+    for hit, share in zip(eligible, shares):
+        if remaining <= 0:
+            break
+        text = _trim_section(hit.get("text") or "", terms, min(share, remaining))
+        if not text:
+            continue
+        remaining -= estimate_tokens(text)
+        packed.append({**hit, "text": text})
+
+    context_tokens = sum(estimate_tokens(h["text"]) for h in packed)
+    stats = {
+        "original_tokens": original_tokens,
+        "context_tokens": context_tokens,
+        "dropped_hits": len(hits) - len(packed),
+    }
+    return packed, stats
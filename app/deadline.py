@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import os
+import time
+from typing import Optional
+
+REQUEST_DEADLINE_SEC = float(os.getenv("REQUEST_DEADLINE_SEC", "0"))
+
+
+class DeadlineExceeded(RuntimeError):
+    """Raised when a request stage runs out of its time budget."""
+
+    def __init__(self, stage: str):
+        super().__init__(f"deadline exceeded during {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """Wall-clock budget for a single request.
+
+    The budget is set once when the request starts and every stage asks for
+    the time that is left, so slow stages eat into the budget of later ones
+    instead of each getting its own fixed timeout. A budget of ``None`` (or
+    <= 0) means "no deadline"; stages then fall back to their own caps.
+    """
+
+    def __init__(self, budget_sec: Optional[float] = None):
+        if budget_sec is not None and budget_sec <= 0:
+            budget_sec = None
+        self.budget_sec = budget_sec
+        self.started_at = time.monotonic()
+        self.expires_at = None if budget_sec is None else self.started_at + budget_sec
+
+    def remaining(self) -> float:
+        if self.expires_at is None:
+            return float("inf")
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0.0
+
+    def timeout(self, cap: float) -> float:
+        """Timeout for the next stage: its own cap, bounded by what is left."""
+        return min(cap, self.remaining())
+
+    def check(self, stage: str) -> None:
+        if self.expired():
+            raise DeadlineExceeded(stage)
+
+
+def request_deadline(deadline_ms: Optional[float] = None) -> Deadline:
+    if deadline_ms is not None:
+        # An explicit budget must be positive; only omitting it means "no deadline".
+        if deadline_ms <= 0:
+            raise ValueError("deadline_ms must be > 0")
+        return Deadline(deadline_ms / 1000.0)
+    return Deadline(REQUEST_DEADLINE_SEC)
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+from collections import defaultdict
+from typing import Dict, FrozenSet, List, Sequence
+
+DEDUP_MIN_JACCARD = float(os.getenv("DEDUP_MIN_JACCARD", "0.8"))
+DEDUP_MIN_TOKENS = int(os.getenv("DEDUP_MIN_TOKENS", "20"))
+
+_TOKEN_RE = re.compile(r"[a-z0-9_]+")
+_SHINGLE = 3
+# MinHash signature of 32 values in 8 bands of 4 rows: pairs with Jaccard
+# >= ~0.6 become candidates with high probability; candidates are then
+# checked against DEDUP_MIN_JACCARD exactly.
+_BANDS = 8
+_ROWS = 4
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 64) - 1
+_PERMS = [
+    (
+        int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "little") % _PRIME or 1,
+        int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "little") % _PRIME,
+    )
+    for i in range(_BANDS * _ROWS)
+]
+
+
+def shingles(text: str) -> FrozenSet[str]:
+    """Word 3-shingles of a chunk body, ignoring the ingest heading prefix.
+
+    Only the "Section:" line is dropped (titles carry the version, e.g.
+    "Guide (v1.0)"). Version numbers in the body are kept: "TLS 1.0" and
+    "TLS 1.3" are different facts.
+    """
+    body = text
+    if body.startswith("Section: "):
+        body = body.split("\n", 1)[1] if "\n" in body else ""
+    tokens = _TOKEN_RE.findall(body.lower())
+    if len(tokens) < DEDUP_MIN_TOKENS:
+        return frozenset()
+    return frozenset(" ".join(tokens[i : i + _SHINGLE]) for i in range(len(tokens) - _SHINGLE + 1))
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def minhash(shingle_set: FrozenSet[str]) -> List[int]:
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") for s in shingle_set]
+    return [min(((a * h + b) & _MASK) % _PRIME for h in hashes) for a, b in _PERMS]
+
+
+def near_duplicate_clusters(texts: Sequence[str], min_jaccard: float = DEDUP_MIN_JACCARD) -> List[List[int]]:
+    """Group indexes of near-identical ``texts``. Only clusters of 2+ are returned.
+
+    Texts shorter than DEDUP_MIN_TOKENS never cluster: short sections share
+    too much boilerplate for the comparison to be meaningful.
+    """
+    sets: Dict[int, FrozenSet[str]] = {}
+    buckets: Dict[tuple, List[int]] = defaultdict(list)
+    for idx, text in enumerate(texts):
+        shingle_set = shingles(text)
+        if not shingle_set:
+            continue
+        sets[idx] = shingle_set
+        signature = minhash(shingle_set)
+        for band in range(_BANDS):
+            buckets[(band, tuple(signature[band * _ROWS : (band + 1) * _ROWS]))].append(idx)
+
+    parent = {idx: idx for idx in sets}
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for members in buckets.values():
+        for pos, a in enumerate(members):
+            for b in members[pos + 1 :]:
+                if find(a) != find(b) and jaccard(sets[a], sets[b]) >= min_jaccard:
+                    parent[find(b)] = find(a)
+
+    groups: Dict[int, List[int]] = defaultdict(list)
+    for idx in sets:
+        groups[find(idx)].append(idx)
+    return sorted([sorted(g) for g in groups.values() if len(g) > 1])
+
+
+def drop_near_duplicate_hits(hits: List[Dict], min_jaccard: float = DEDUP_MIN_JACCARD) -> List[Dict]:
+    """Keep the closest hit of every near-duplicate group, preserving rank order."""
+    kept: List[Dict] = []
+    kept_sets: List[FrozenSet[str]] = []
+    for hit in hits:  # ranked by distance, so the first of a group is the closest
+        shingle_set = shingles(hit.get("text") or "")
+        if shingle_set and any(jaccard(shingle_set, other) >= min_jaccard for other in kept_sets):
+            continue
+        kept.append(hit)
+        kept_sets.append(shingle_set)
+    return kept
@@ -3,8 +3,9 @@ from __future__ import annotations
 import hashlib
 import json
 import os
+import urllib.error
 import urllib.request
-from typing import List, Sequence
+from typing import Any, Dict, List, Optional, Sequence
 
 try:
     # Chroma uses this protocol for custom embeddings
@@ -29,6 +30,10 @@ class HashEmbeddingFunction(EmbeddingFunction):
         self.dim = dim
 
     def __call__(self, texts: Sequence[str]) -> List[List[float]]:
+        return self.embed(texts)
+
+    def embed(self, texts: Sequence[str], timeout_sec: Optional[float] = None) -> List[List[float]]:
+        # Pure CPU work; the timeout is accepted for interface parity only.
         vectors: List[List[float]] = []
         for text in texts:
             vec = [0.0] * self.dim
@@ -52,25 +57,53 @@ class OllamaEmbeddingFunction(EmbeddingFunction):
         self.model = model
         self.base_url = base_url.rstrip("/")
         self.timeout_sec = timeout_sec
+        # Every call (ingest, /ask, replay) goes through one endpoint so an index
+        # is built and queried the same way; "/api/embeddings" only on servers
+        # that predate "/api/embed". Recorded in snapshot manifests.
+        self.endpoint = "/api/embed"
 
     def __call__(self, texts: Sequence[str]) -> List[List[float]]:
+        return self.embed(texts)
+
+    def embed(self, texts: Sequence[str], timeout_sec: Optional[float] = None) -> List[List[float]]:
+        timeout = self.timeout_sec if timeout_sec is None else timeout_sec
+        if not texts:
+            return []
+        if self.endpoint == "/api/embed":
+            try:
+                return self._embed_batch(texts, timeout)
+            except urllib.error.HTTPError as exc:
+                if exc.code != 404:
+                    raise
+                # Ollama before /api/embed: one request per text from now on.
+                self.endpoint = "/api/embeddings"
         vectors: List[List[float]] = []
         for text in texts:
-            payload = json.dumps({"model": self.model, "prompt": text}).encode("utf-8")
-            req = urllib.request.Request(
-                f"{self.base_url}/api/embeddings",
-                data=payload,
-                headers={"Content-Type": "application/json"},
-                method="POST",
-            )
-            with urllib.request.urlopen(req, timeout=self.timeout_sec) as resp:
-                data = json.loads(resp.read().decode("utf-8"))
+            data = self._post("/api/embeddings", {"model": self.model, "prompt": text}, timeout)
             embedding = data.get("embedding")
             if not isinstance(embedding, list):
                 raise RuntimeError("Ollama embeddings response missing 'embedding'")
             vectors.append(embedding)
         return vectors
 
+    def _embed_batch(self, texts: Sequence[str], timeout: float) -> List[List[float]]:
+        """All ``texts`` in one round trip (``/api/embed``)."""
+        data = self._post("/api/embed", {"model": self.model, "input": list(texts)}, timeout)
+        embeddings = data.get("embeddings")
+        if not isinstance(embeddings, list) or len(embeddings) != len(texts):
+            raise RuntimeError("Ollama embed response missing 'embeddings'")
+        return embeddings
+
+    def _post(self, path: str, body: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        req = urllib.request.Request(
+            f"{self.base_url}{path}",
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return json.loads(resp.read().decode("utf-8"))
+
 
 def get_embedding_function() -> EmbeddingFunction:
     provider = os.getenv("EMBEDDING_PROVIDER", "hash").lower()
@@ -83,3 +116,12 @@ def get_embedding_function() -> EmbeddingFunction:
         return OllamaEmbeddingFunction(model=model, base_url=base_url, timeout_sec=timeout_sec)
     dim = int(os.getenv("EMBED_DIM", "256"))
     return HashEmbeddingFunction(dim=dim)
+
+
+def describe_embedding_function(fn: EmbeddingFunction) -> Dict[str, Any]:
+    """Provider/model/dim of an embedding function, as recorded in snapshot manifests."""
+    if isinstance(fn, OllamaEmbeddingFunction):
+        return {"provider": "ollama", "model": fn.model, "endpoint": fn.endpoint}
+    if isinstance(fn, HashEmbeddingFunction):
+        return {"provider": "hash", "model": None, "dim": fn.dim}
+    return {"provider": type(fn).__name__, "model": None}
@@ -2,9 +2,13 @@ from __future__ import annotations
 
 import json
 import os
+import time
 import urllib.request
 from typing import Any, Dict, List, Optional
 
+from .context import estimate_tokens, pack_context
+from .metrics import generation_latency_seconds, prompt_tokens, prompt_truncation_ratio
+
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL")
 OLLAMA_TIMEOUT_SEC = float(os.getenv("OLLAMA_TIMEOUT_SEC", "15"))
@@ -25,11 +29,21 @@ def _build_prompt(query: str, hits: List[Dict[str, Any]], requested_version: Opt
 
 
 def generate_with_ollama(
-    query: str, hits: List[Dict[str, Any]], requested_version: Optional[str]
+    query: str,
+    hits: List[Dict[str, Any]],
+    requested_version: Optional[str],
+    timeout_sec: Optional[float] = None,
 ) -> Optional[str]:
     if not OLLAMA_MODEL:
         return None
-    prompt = _build_prompt(query, hits, requested_version)
+    timeout = OLLAMA_TIMEOUT_SEC if timeout_sec is None else min(timeout_sec, OLLAMA_TIMEOUT_SEC)
+    if timeout <= 0:
+        return None
+    packed, stats = pack_context(query, hits)
+    prompt = _build_prompt(query, packed, requested_version)
+    prompt_tokens.observe(estimate_tokens(prompt))
+    if stats["original_tokens"]:
+        prompt_truncation_ratio.observe(1.0 - stats["context_tokens"] / stats["original_tokens"])
     payload = json.dumps(
         {
             "model": OLLAMA_MODEL,
@@ -43,11 +57,14 @@ def generate_with_ollama(
         headers={"Content-Type": "application/json"},
         method="POST",
     )
+    start = time.time()
     try:
-        with urllib.request.urlopen(req, timeout=OLLAMA_TIMEOUT_SEC) as resp:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
             body = resp.read().decode("utf-8")
     except Exception:
         return None
+    finally:
+        generation_latency_seconds.observe(time.time() - start)
 
     try:
         data = json.loads(body)
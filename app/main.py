@@ -1,18 +1,25 @@
 from __future__ import annotations
 
+import hmac
 import json
 import os
 import re
 import time
 import uuid
 from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
 from typing import Any, Dict, List, Optional, Tuple
-from fastapi.responses import Response
 
-from fastapi import FastAPI
-from pydantic import BaseModel
+# Taken before the third-party imports so import_seconds covers them.
+_IMPORT_STARTED = time.perf_counter()
+
+from fastapi.responses import JSONResponse, Response
+
+from fastapi import Depends, FastAPI, Header, HTTPException
+from pydantic import BaseModel, Field
 from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
+from .deadline import DeadlineExceeded, request_deadline
 from .llm import generate_with_ollama
 from .metrics import (
     queries_total,
@@ -25,66 +32,35 @@ from .metrics import (
     low_coverage_total,
     weak_evidence_total,
     request_latency_seconds,
+    deadline_exceeded_total,
+    import_seconds,
 )
 from .logger import log_event, LOG_FILE
-from .store import query as chroma_query
-from .rules import extract_requested_version, is_unsupported_feature_question, has_version_conflict
+from . import store
+from .snapshots import SnapshotError, list_snapshots
+from .rules import (
+    MIN_CITATIONS,
+    classify_issues,
+    extract_requested_version,
+    has_version_conflict,
+    is_unsupported_feature_question,
+)
+from .startup import readiness, start_docs_watch, start_preload, start_snapshot_watch
+
+import_seconds.set(time.perf_counter() - _IMPORT_STARTED)
 
 APP_NAME = os.getenv("APP_NAME", "ai-docs-observability-demo")
 TOP_K = int(os.getenv("TOP_K", "4"))
-MIN_CITATIONS = int(os.getenv("MIN_CITATIONS", "1"))
 LATEST_VERSION = os.getenv("LATEST_VERSION", "1.1")
-MAX_TOP_DISTANCE = float(os.getenv("MAX_TOP_DISTANCE", "0.55"))
-MAX_AVG_DISTANCE = float(os.getenv("MAX_AVG_DISTANCE", "0.65"))
-
-_STOPWORDS = {
-    "what",
-    "does",
-    "how",
-    "is",
-    "are",
-    "the",
-    "a",
-    "an",
-    "in",
-    "of",
-    "for",
-    "to",
-    "and",
-    "or",
-    "with",
-    "on",
-    "it",
-    "this",
-    "that",
-    "do",
-    "i",
-    "we",
-    "you",
-    "work",
-    "works",
-    "when",
-    "where",
-    "which",
-    "from",
-    "about",
-    "used",
-    "using",
-    "help",
-    "need",
-    "want",
-    "will",
-    "have",
-    "been",
-    "were",
-    "some",
-    "more",
-    "also",
-}
+# Snapshot activate/rollback switch the served index and rewrite CURRENT, so
+# they are off unless ADMIN_TOKEN is set, and then need "Authorization: Bearer <token>".
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
 
 
 class AskRequest(BaseModel):
     query: str
+    # Overall time budget for this request; falls back to REQUEST_DEADLINE_SEC when omitted.
+    deadline_ms: Optional[float] = Field(default=None, gt=0)
 
 
 class Citation(BaseModel):
@@ -103,6 +79,7 @@ class AskResponse(BaseModel):
     refusal_reason: Optional[str] = None
     citations: List[Citation] = []
     requested_version: Optional[str] = None
+    deadline_exceeded: bool = False
 
 
 class UnansweredQuery(BaseModel):
@@ -127,7 +104,17 @@ class IssuesResponse(BaseModel):
     issues: List[IssueRow]
 
 
-app = FastAPI(title=APP_NAME)
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # Index loading happens in the background so /healthz answers right away;
+    # /readyz flips once the collection is open and warmed.
+    start_preload(_IMPORT_STARTED)
+    start_snapshot_watch()
+    start_docs_watch()
+    yield
+
+
+app = FastAPI(title=APP_NAME, lifespan=lifespan)
 
 
 @app.get("/healthz")
@@ -135,14 +122,69 @@ def healthz():
     return {"ok": True, "app": APP_NAME}
 
 
+@app.get("/readyz")
+def readyz():
+    state = readiness()
+    return JSONResponse(status_code=200 if state["ready"] else 503, content=state)
+
+
 @app.get("/metrics")
 def metrics():
     return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
+@app.get("/admin/snapshots")
+def admin_snapshots():
+    return {"active": store.active_snapshot(), "snapshots": list_snapshots()}
+
+
+def require_admin(authorization: Optional[str] = Header(default=None)) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set ADMIN_TOKEN to enable them")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+
+
+@app.post("/admin/snapshots/activate", dependencies=[Depends(require_admin)])
+def admin_activate_snapshot(snapshot_id: Optional[str] = None):
+    try:
+        active = store.activate_snapshot(snapshot_id, publish=True)
+    except FileNotFoundError as exc:
+        raise HTTPException(status_code=404, detail=str(exc))
+    except SnapshotError as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    return {"active": active}
+
+
+@app.post("/admin/snapshots/rollback", dependencies=[Depends(require_admin)])
+def admin_rollback_snapshot():
+    try:
+        active = store.rollback_snapshot()
+    except FileNotFoundError as exc:
+        raise HTTPException(status_code=404, detail=str(exc))
+    except SnapshotError as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    return {"active": active}
+
+
+def _one_per_section(citations: List[Citation]) -> List[Citation]:
+    """Keep the closest chunk of every section, so split sections are cited (and rolled up) once."""
+    seen = set()
+    out: List[Citation] = []
+    for c in citations:  # ranked by distance
+        key = c.section_id or (c.source, c.heading)
+        if key in seen:
+            continue
+        seen.add(key)
+        out.append(c)
+    return out
+
+
 @app.post("/ask", response_model=AskResponse)
 def ask(req: AskRequest):
     start = time.time()
+    deadline = request_deadline(req.deadline_ms)
     queries_total.inc()
     query_id = str(uuid.uuid4())
 
@@ -171,7 +213,27 @@ def ask(req: AskRequest):
         unsupported_feature_questions_total.inc()
         log_event({"type": "unsupported_feature_question", "query": q, "requested_version": requested_version})
 
-    hits = chroma_query(q, n_results=TOP_K, where={"version": requested_version})
+    try:
+        hits = store.retrieve(q, n_results=TOP_K, version=requested_version, deadline=deadline)
+    except DeadlineExceeded as exc:
+        # Nothing retrieved in time: there is no partial result worth returning.
+        # Keep this out of the unanswered signal, it is a latency issue, not a docs bug.
+        deadline_exceeded_total.labels(stage=exc.stage).inc()
+        log_event(
+            {
+                "type": "query_result",
+                "query_id": query_id,
+                "query": q,
+                "issue_types": [],
+                "requested_version": requested_version,
+                "top_citations": [],
+                "answer_mode": "deadline_exceeded",
+                "deadline_exceeded": True,
+                "deadline_stage": exc.stage,
+            }
+        )
+        request_latency_seconds.observe(time.time() - start)
+        return AskResponse(answer=None, requested_version=requested_version, deadline_exceeded=True)
     citations = [
         Citation(
             source=h["meta"].get("source", "unknown"),
@@ -221,31 +283,28 @@ def ask(req: AskRequest):
 
     # Naive answer synthesis for the demo:
     # We do NOT claim this is a good generative model — we're demonstrating telemetry.
-    answer = generate_with_ollama(q, hits, requested_version)
+    # Generation only gets what is left of the request budget; if that runs out
+    # we fall back to the citations-only answer below.
+    deadline_stage: Optional[str] = None
+    if deadline.expired():
+        answer = None
+        deadline_stage = "generation"
+    else:
+        answer = generate_with_ollama(q, hits, requested_version, timeout_sec=deadline.remaining())
+        if not answer and deadline.expired():
+            deadline_stage = "generation"
+    if deadline_stage:
+        deadline_exceeded_total.labels(stage=deadline_stage).inc()
+    sections = _one_per_section(citations)
     if not answer:
         answer = (
             "Based on the documentation, here are the most relevant sections:\n"
-            + "\n".join([f"- {c.title} (v{c.version})" if c.version else f"- {c.title}" for c in citations[:3]])
+            + "\n".join([f"- {c.title} (v{c.version})" if c.version else f"- {c.title}" for c in sections[:3]])
         )
     if vc:
         answer += "\n\nWarning: Evidence spans multiple versions. Treat this as a docs/versioning issue."
 
-    issue_types: List[str] = []
-    if vc:
-        issue_types.append("version_conflict")
-    if is_unsupported_feature_question(q, requested_version):
-        issue_types.append("unsupported_feature")
-    if citations:
-        distances = [c.distance for c in citations]
-        if min(distances) > MAX_TOP_DISTANCE:
-            issue_types.append("weak_evidence")
-        if (sum(distances) / len(distances)) > MAX_AVG_DISTANCE:
-            issue_types.append("low_relevance")
-        tokens = [t for t in re.findall(r"[a-z0-9_]+", q.lower()) if len(t) >= 4 and t not in _STOPWORDS]
-        if tokens:
-            hit_text = " ".join([(h.get("text") or "") for h in hits]).lower()
-            if not any(re.search(rf"\b{re.escape(t)}\b", hit_text) for t in tokens):
-                issue_types.append("low_coverage")
+    issue_types = classify_issues(q, hits, requested_version)
     for issue_type in issue_types:
         issue_types_total.labels(issue_type=issue_type).inc()
     if "weak_evidence" in issue_types:
@@ -261,7 +320,7 @@ def ask(req: AskRequest):
             "version": c.version,
             "distance": c.distance,
         }
-        for c in citations[:3]
+        for c in sections[:3]
     ]
     log_event(
         {
@@ -272,6 +331,8 @@ def ask(req: AskRequest):
             "requested_version": requested_version,
             "top_citations": top_citations,
             "answer_mode": "answered",
+            "deadline_exceeded": deadline_stage is not None,
+            "deadline_stage": deadline_stage,
         }
     )
 
@@ -283,6 +344,7 @@ def ask(req: AskRequest):
         refused=False,
         citations=citations,
         requested_version=requested_version,
+        deadline_exceeded=deadline_stage is not None,
     )
 
 
@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from prometheus_client import Counter, Histogram
+from prometheus_client import Counter, Gauge, Histogram
 
 NAMESPACE = "ai_docs"
 
@@ -56,3 +56,77 @@ request_latency_seconds = Histogram(
     "Latency for /ask requests",
     buckets=(0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 3.2, 6.4),
 )
+
+deadline_exceeded_total = Counter(
+    f"{NAMESPACE}_deadline_exceeded_total",
+    "Requests that ran out of their deadline budget, by the stage that hit it",
+    labelnames=("stage",),
+)
+
+prompt_tokens = Histogram(
+    f"{NAMESPACE}_prompt_tokens",
+    "Estimated tokens in prompts sent for generation",
+    buckets=(128, 256, 512, 768, 1024, 1536, 2048, 4096, 8192),
+)
+
+prompt_truncation_ratio = Histogram(
+    f"{NAMESPACE}_prompt_truncation_ratio",
+    "Fraction of retrieved context tokens dropped by the context packer",
+    buckets=(0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 1.0),
+)
+
+generation_latency_seconds = Histogram(
+    f"{NAMESPACE}_generation_latency_seconds",
+    "Latency of Ollama generation calls",
+    buckets=(0.1, 0.2, 0.4, 0.8, 1.6, 3.2, 6.4, 12.8),
+)
+
+import_seconds = Gauge(
+    f"{NAMESPACE}_import_seconds",
+    "Time spent importing the app module at startup",
+)
+
+time_to_ready_seconds = Gauge(
+    f"{NAMESPACE}_time_to_ready_seconds",
+    "Time from app import until the index was preloaded and serving was ready",
+)
+
+index_sections = Gauge(
+    f"{NAMESPACE}_index_sections",
+    "Number of sections in the loaded Chroma collection",
+)
+
+snapshot_load_seconds = Histogram(
+    f"{NAMESPACE}_snapshot_load_seconds",
+    "Time to open and warm an index snapshot before serving it",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+active_snapshot_info = Gauge(
+    f"{NAMESPACE}_active_snapshot_info",
+    "Index snapshot currently served (value is always 1)",
+    labelnames=("snapshot_id",),
+)
+
+ingest_lag_seconds = Histogram(
+    f"{NAMESPACE}_ingest_lag_seconds",
+    "Time from a docs file change to its sections being re-indexed (watch mode)",
+    buckets=(0.5, 1, 2, 4, 8, 16, 32, 64),
+)
+
+ingest_file_seconds = Histogram(
+    f"{NAMESPACE}_ingest_file_seconds",
+    "Time to re-split and upsert/delete the sections of one changed file (watch mode)",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+ingest_files_total = Counter(
+    f"{NAMESPACE}_ingest_files_total",
+    "Docs files re-indexed by watch mode, by change type",
+    labelnames=("change",),
+)
+
+duplicate_hits_dropped_total = Counter(
+    f"{NAMESPACE}_duplicate_hits_dropped_total",
+    "Retrieved hits dropped from the top-K as near-duplicates of a closer hit",
+)
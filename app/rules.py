@@ -1,8 +1,14 @@
 from __future__ import annotations
 
+import os
 import re
 from typing import List, Dict, Any, Optional, Tuple
 
+# Evidence thresholds for issue classification (shared by /ask and scripts.replay).
+MIN_CITATIONS = int(os.getenv("MIN_CITATIONS", "1"))
+MAX_TOP_DISTANCE = float(os.getenv("MAX_TOP_DISTANCE", "0.55"))
+MAX_AVG_DISTANCE = float(os.getenv("MAX_AVG_DISTANCE", "0.65"))
+
 SUPPORTED_FEATURES_BY_VERSION = {
     "1.0": {"collections", "basic queries", "indexes"},
     "1.1": {"collections", "basic queries", "indexes", "feature x"},
@@ -10,6 +16,51 @@ SUPPORTED_FEATURES_BY_VERSION = {
 
 UNSUPPORTED_FEATURES = {"sharding"}  # demo
 
+_STOPWORDS = {
+    "what",
+    "does",
+    "how",
+    "is",
+    "are",
+    "the",
+    "a",
+    "an",
+    "in",
+    "of",
+    "for",
+    "to",
+    "and",
+    "or",
+    "with",
+    "on",
+    "it",
+    "this",
+    "that",
+    "do",
+    "i",
+    "we",
+    "you",
+    "work",
+    "works",
+    "when",
+    "where",
+    "which",
+    "from",
+    "about",
+    "used",
+    "using",
+    "help",
+    "need",
+    "want",
+    "will",
+    "have",
+    "been",
+    "were",
+    "some",
+    "more",
+    "also",
+}
+
 
 def extract_requested_version(query: str) -> Optional[str]:
     m = re.search(r"v(\d+\.\d+)", query.lower())
@@ -18,6 +69,11 @@ def extract_requested_version(query: str) -> Optional[str]:
     return None
 
 
+def query_terms(query: str, min_len: int = 4) -> List[str]:
+    """Content words of a query (lowercase, >= ``min_len`` chars, no stopwords)."""
+    return [t for t in re.findall(r"[a-z0-9_]+", query.lower()) if len(t) >= min_len and t not in _STOPWORDS]
+
+
 def mentions_feature_x(query: str) -> bool:
     return "feature x" in query.lower()
 
@@ -41,3 +97,60 @@ def has_version_conflict(citations: List[Dict[str, Any]], requested_version: Opt
         versions.add(requested_version)
     versions.discard(None)
     return len(versions) >= 2
+
+
+def evidence_features(query: str, hits: List[Dict[str, Any]], requested_version: Optional[str]) -> Dict[str, Any]:
+    """Threshold-independent facts about retrieved evidence.
+
+    Split from ``issues_from_features`` so callers that try many thresholds
+    (scripts.replay) compute the expensive parts once.
+    """
+    distances = [float(h["distance"]) for h in hits]
+    low_coverage = False
+    tokens = query_terms(query)
+    if hits and tokens:
+        hit_text = " ".join([(h.get("text") or "") for h in hits]).lower()
+        low_coverage = not any(re.search(rf"\b{re.escape(t)}\b", hit_text) for t in tokens)
+    return {
+        "hits": len(hits),
+        "min_distance": min(distances) if distances else None,
+        "avg_distance": (sum(distances) / len(distances)) if distances else None,
+        "version_conflict": has_version_conflict([h.get("meta") or {} for h in hits], requested_version),
+        "unsupported_feature": is_unsupported_feature_question(query, requested_version),
+        "low_coverage": low_coverage,
+    }
+
+
+def issues_from_features(
+    features: Dict[str, Any],
+    min_citations: int = MIN_CITATIONS,
+    max_top_distance: float = MAX_TOP_DISTANCE,
+    max_avg_distance: float = MAX_AVG_DISTANCE,
+) -> List[str]:
+    if features["hits"] < min_citations:
+        return ["unanswered"]
+    issue_types: List[str] = []
+    if features["version_conflict"]:
+        issue_types.append("version_conflict")
+    if features["unsupported_feature"]:
+        issue_types.append("unsupported_feature")
+    if features["hits"]:
+        if features["min_distance"] > max_top_distance:
+            issue_types.append("weak_evidence")
+        if features["avg_distance"] > max_avg_distance:
+            issue_types.append("low_relevance")
+        if features["low_coverage"]:
+            issue_types.append("low_coverage")
+    return issue_types
+
+
+def classify_issues(
+    query: str,
+    hits: List[Dict[str, Any]],
+    requested_version: Optional[str],
+    min_citations: int = MIN_CITATIONS,
+    max_top_distance: float = MAX_TOP_DISTANCE,
+    max_avg_distance: float = MAX_AVG_DISTANCE,
+) -> List[str]:
+    features = evidence_features(query, hits, requested_version)
+    return issues_from_features(features, min_citations, max_top_distance, max_avg_distance)
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+# Layout under CHROMA_PERSIST_DIR:
+#   snapshots/<snapshot_id>/            one immutable Chroma store per ingest run
+#   snapshots/<snapshot_id>/manifest.json  written last; a snapshot without it is incomplete
+#   CURRENT                             id of the snapshot the app should serve
+# A persist dir without CURRENT is served directly (pre-snapshot layout).
+PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", "chroma_data")
+SNAPSHOTS_DIR = os.path.join(PERSIST_DIR, "snapshots")
+CURRENT_FILE = os.path.join(PERSIST_DIR, "CURRENT")
+MANIFEST_NAME = "manifest.json"
+LEGACY_SNAPSHOT_ID = "legacy"
+LEGACY_DB_NAME = "chroma.sqlite3"
+
+
+class SnapshotError(RuntimeError):
+    """Raised when a snapshot is incomplete or incompatible with the running app."""
+
+
+def new_snapshot_id(corpus_hash: str) -> str:
+    stamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    return f"{stamp}-{corpus_hash[:8]}"
+
+
+def snapshot_path(snapshot_id: str) -> str:
+    if snapshot_id == LEGACY_SNAPSHOT_ID:
+        return PERSIST_DIR
+    if not snapshot_id or os.sep in snapshot_id or snapshot_id.startswith("."):
+        raise SnapshotError(f"Invalid snapshot id: {snapshot_id!r}")
+    return os.path.join(SNAPSHOTS_DIR, snapshot_id)
+
+
+def has_legacy_store() -> bool:
+    """Whether the persist dir root holds a pre-snapshot Chroma store."""
+    return os.path.exists(os.path.join(PERSIST_DIR, LEGACY_DB_NAME))
+
+
+def write_manifest(snapshot_id: str, manifest: Dict[str, Any]) -> None:
+    path = os.path.join(snapshot_path(snapshot_id), MANIFEST_NAME)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def read_manifest(snapshot_id: str) -> Dict[str, Any]:
+    if snapshot_id == LEGACY_SNAPSHOT_ID:
+        if not has_legacy_store():
+            raise FileNotFoundError(f"No legacy Chroma store in {PERSIST_DIR}")
+        return {"snapshot_id": LEGACY_SNAPSHOT_ID}
+    path = os.path.join(snapshot_path(snapshot_id), MANIFEST_NAME)
+    if not os.path.exists(path):
+        if os.path.isdir(snapshot_path(snapshot_id)):
+            raise SnapshotError(f"Snapshot {snapshot_id} is incomplete (no manifest)")
+        raise FileNotFoundError(f"Unknown snapshot: {snapshot_id}")
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def list_snapshots() -> List[Dict[str, Any]]:
+    if not os.path.isdir(SNAPSHOTS_DIR):
+        return []
+    out: List[Dict[str, Any]] = []
+    for name in sorted(os.listdir(SNAPSHOTS_DIR)):
+        try:
+            out.append(read_manifest(name))
+        except (SnapshotError, FileNotFoundError, json.JSONDecodeError):
+            continue
+    return out
+
+
+def read_current() -> Optional[str]:
+    try:
+        with open(CURRENT_FILE, "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def publish_current(snapshot_id: str) -> None:
+    """Point CURRENT at ``snapshot_id`` (atomic rename, readers never see a partial file)."""
+    read_manifest(snapshot_id)
+    os.makedirs(PERSIST_DIR, exist_ok=True)
+    tmp = CURRENT_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(snapshot_id + "\n")
+    os.replace(tmp, CURRENT_FILE)
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from .metrics import time_to_ready_seconds
+
+PRELOAD_INDEX = os.getenv("PRELOAD_INDEX", "1").lower() not in {"0", "false", "no"}
+SNAPSHOT_WATCH_SEC = float(os.getenv("SNAPSHOT_WATCH_SEC", "5"))
+INGEST_WATCH = os.getenv("INGEST_WATCH", "0").lower() in {"1", "true", "yes"}
+PRELOAD_MAX_BACKOFF_SEC = float(os.getenv("PRELOAD_MAX_BACKOFF_SEC", "30"))
+
+_state: Dict[str, Any] = {"ready": False, "error": None, "sections": None}
+_started_at = time.perf_counter()
+_ready_lock = threading.Lock()
+_thread: Optional[threading.Thread] = None
+_watch_thread: Optional[threading.Thread] = None
+_docs_watch_thread: Optional[threading.Thread] = None
+
+
+def mark_ready(sections: Optional[int] = None) -> None:
+    """Record that a collection is being served.
+
+    Called by ``store`` whenever it installs a collection, so readiness flips
+    no matter which path loaded it first (preload, a lazy /ask, the snapshot
+    watcher or an admin swap).
+    """
+    with _ready_lock:
+        if sections is not None:
+            _state["sections"] = sections
+        _state["error"] = None
+        if not _state["ready"]:
+            time_to_ready_seconds.set(time.perf_counter() - _started_at)
+            _state["ready"] = True
+
+
+def _preload() -> None:
+    from . import store
+
+    # Retry with exponential backoff: a dependency that is down at boot (e.g.
+    # Ollama for the warmup embedding) must not keep /readyz at 503 forever.
+    delay = 1.0
+    while not _state["ready"]:
+        try:
+            store.preload()
+            return
+        except Exception as exc:
+            _state["error"] = f"{type(exc).__name__}: {exc}"
+        time.sleep(delay)
+        delay = min(delay * 2, PRELOAD_MAX_BACKOFF_SEC)
+
+
+def start_preload(started_at: float) -> None:
+    """Load the index in a background thread so the server can accept requests immediately."""
+    global _thread, _started_at
+    _started_at = started_at
+    if not PRELOAD_INDEX:
+        mark_ready()
+        return
+    if _thread is not None:
+        return
+    _thread = threading.Thread(target=_preload, name="index-preload", daemon=True)
+    _thread.start()
+
+
+def readiness() -> Dict[str, Any]:
+    return dict(_state)
+
+
+def _watch_current(interval: float) -> None:
+    from . import snapshots, store
+
+    failed: Optional[str] = None
+    while True:
+        time.sleep(interval)
+        current = snapshots.read_current()
+        active = store.active_snapshot()["snapshot_id"]
+        # Before the first load the preload (or first request) picks CURRENT up itself.
+        if not current or active is None or current in (active, failed):
+            continue
+        try:
+            store.activate_snapshot(current)
+        except Exception as exc:  # keep serving the old snapshot
+            failed = current
+            _state["error"] = f"{type(exc).__name__}: {exc}"
+
+
+def start_snapshot_watch() -> None:
+    """Poll the CURRENT pointer and hot-swap to new snapshots published by ingest."""
+    global _watch_thread
+    if SNAPSHOT_WATCH_SEC <= 0 or _watch_thread is not None:
+        return
+    _watch_thread = threading.Thread(
+        target=_watch_current, args=(SNAPSHOT_WATCH_SEC,), name="snapshot-watch", daemon=True
+    )
+    _watch_thread.start()
+
+
+def start_docs_watch() -> None:
+    """Re-index changed docs files in the served collection (INGEST_WATCH=1).
+
+    The served snapshot is edited in place; its manifest is marked
+    ``modified_by_watch`` after every batch.
+
+    This runs in the app process because the app keeps its own in-memory
+    vector index; writes from a separate watcher process would not show up
+    until the next snapshot swap.
+    """
+    global _docs_watch_thread
+    if not INGEST_WATCH or _docs_watch_thread is not None:
+        return
+    from scripts.watch import DocsWatcher
+
+    from . import store
+
+    watcher = DocsWatcher(store.active_collection, on_batch=store.record_watch_update)
+    _docs_watch_thread = threading.Thread(target=watcher.run, name="docs-watch", daemon=True)
+    _docs_watch_thread.start()
@@ -1,34 +1,269 @@
 from __future__ import annotations
 
+import json
 import os
-from typing import List, Dict, Any, Optional
+import re
+import threading
+import time
+from typing import List, Dict, Any, Optional, Tuple
 
-import chromadb
-from chromadb.config import Settings
+from . import snapshots
+from .deadline import Deadline, DeadlineExceeded
+from .dedup import drop_near_duplicate_hits
+from .metrics import active_snapshot_info, duplicate_hits_dropped_total, index_sections, snapshot_load_seconds
 
-from .embeddings import get_embedding_function
-
-PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", "chroma_data")
+PERSIST_DIR = snapshots.PERSIST_DIR
 COLLECTION_NAME = os.getenv("CHROMA_COLLECTION", "docs")
+# retrieve() drops near-duplicate hits; it fetches this many times n_results
+# so the dropped slots are backfilled with the next-closest hits.
+DEDUP_OVERFETCH = max(int(os.getenv("DEDUP_OVERFETCH", "2")), 1)
 
-_embed = get_embedding_function()
+# chromadb and the embedding function are heavy to import/build, so both are
+# created on first use (or by preload() from the app startup hook) instead of
+# at import time.
+_embed = None
+_init_lock = threading.Lock()
 
+# The served index. Requests read this reference once, so swapping it for a
+# new snapshot never affects queries that are already running.
+_active: Optional[Dict[str, Any]] = None
+_history: List[str] = []
+_swap_lock = threading.Lock()
+# Snapshot id -> path of every Chroma store this process has opened for serving.
+# Only the active and the previous (rollback target) snapshot stay open.
+_open_paths: Dict[str, str] = {}
 
-def get_collection():
-    os.makedirs(PERSIST_DIR, exist_ok=True)
+
+def get_embedding():
+    global _embed
+    if _embed is None:
+        with _init_lock:
+            if _embed is None:
+                from .embeddings import get_embedding_function
+
+                _embed = get_embedding_function()
+    return _embed
+
+
+def open_collection(path: str):
+    embed = get_embedding()
+    import chromadb
+    from chromadb.config import Settings
+
+    os.makedirs(path, exist_ok=True)
     client = chromadb.PersistentClient(
-        path=PERSIST_DIR,
+        path=path,
         settings=Settings(anonymized_telemetry=False),
     )
     return client.get_or_create_collection(
         name=COLLECTION_NAME,
-        embedding_function=_embed,
+        embedding_function=embed,
         metadata={"hnsw:space": "cosine"},
     )
 
 
-def upsert_docs(docs: List[Dict[str, Any]]) -> None:
-    col = get_collection()
+def release_collection(path: str) -> None:
+    """Stop the cached Chroma system for ``path`` so its index is freed from memory.
+
+    chromadb caches one system per persist directory at class level, so a
+    client going out of scope does not release anything on its own. Raises
+    if that cache is not where chromadb (pinned in requirements.txt) keeps
+    it, rather than silently keeping every retired index in memory.
+    """
+    from chromadb.api.shared_system_client import SharedSystemClient
+
+    systems = getattr(SharedSystemClient, "_identifier_to_system", None)
+    if systems is None:
+        raise RuntimeError(
+            "chromadb SharedSystemClient has no _identifier_to_system cache; "
+            "retired snapshots cannot be released"
+        )
+    system = systems.pop(path, None)
+    if system is not None:
+        system.stop()
+
+
+def _release_unused() -> None:
+    keep = {_active["snapshot_id"]} if _active is not None else set()
+    if _history:
+        keep.add(_history[-1])
+    for snapshot_id in [sid for sid in _open_paths if sid not in keep]:
+        release_collection(_open_paths.pop(snapshot_id))
+
+
+def _check_compatible(manifest: Dict[str, Any]) -> None:
+    from .embeddings import describe_embedding_function
+
+    recorded = manifest.get("embedding")
+    if not recorded:
+        return
+    current = describe_embedding_function(get_embedding())
+    if (recorded.get("provider"), recorded.get("model")) != (current.get("provider"), current.get("model")):
+        raise snapshots.SnapshotError(
+            f"Snapshot {manifest.get('snapshot_id')} was built with "
+            f"{recorded.get('provider')}/{recorded.get('model')}, "
+            f"app uses {current.get('provider')}/{current.get('model')}"
+        )
+
+
+def _load(snapshot_id: str, create_legacy: bool = False) -> Dict[str, Any]:
+    """Open and warm a snapshot without serving it yet.
+
+    ``create_legacy`` lets the very first load fall back to an empty store at
+    the persist dir root (fresh deploy, nothing ingested yet); explicit
+    activations of a missing legacy store fail instead.
+    """
+    start = time.perf_counter()
+    if snapshot_id == snapshots.LEGACY_SNAPSHOT_ID and create_legacy:
+        manifest = {"snapshot_id": snapshot_id}
+    else:
+        manifest = snapshots.read_manifest(snapshot_id)
+    _check_compatible(manifest)
+    path = snapshots.snapshot_path(snapshot_id)
+    already_open = snapshot_id in _open_paths
+    col = open_collection(path)
+    _open_paths[snapshot_id] = path
+    try:
+        count = col.count()
+        if count:
+            # One query loads the vector index into memory before traffic hits it.
+            vec = _embed_query("warmup", None)
+            dim = (manifest.get("embedding") or {}).get("dim")
+            if dim and len(vec) != dim:
+                raise snapshots.SnapshotError(
+                    f"Snapshot {snapshot_id} has dimension {dim}, app embeddings have {len(vec)}"
+                )
+            col.query(query_embeddings=[vec], n_results=1)
+    except Exception:
+        if not already_open:
+            release_collection(_open_paths.pop(snapshot_id))
+        raise
+    elapsed = time.perf_counter() - start
+    snapshot_load_seconds.observe(elapsed)
+    return {
+        "snapshot_id": snapshot_id,
+        "collection": col,
+        "manifest": manifest,
+        "sections": count,
+        "load_seconds": elapsed,
+    }
+
+
+def _serve(loaded: Dict[str, Any]) -> None:
+    global _active
+    _active = loaded
+    active_snapshot_info.clear()
+    active_snapshot_info.labels(snapshot_id=loaded["snapshot_id"]).set(1)
+    index_sections.set(loaded["sections"])
+    _release_unused()
+    from .startup import mark_ready
+
+    mark_ready(loaded["sections"])
+
+
+def get_collection():
+    active = _active
+    if active is None:
+        with _swap_lock:
+            if _active is None:
+                current = snapshots.read_current()
+                if current:
+                    _serve(_load(current))
+                else:
+                    _serve(_load(snapshots.LEGACY_SNAPSHOT_ID, create_legacy=True))
+            active = _active
+    return active["collection"]
+
+
+def active_snapshot() -> Dict[str, Any]:
+    active = _active
+    if active is None:
+        return {"snapshot_id": None, "previous": _history[-1] if _history else None}
+    return {
+        "snapshot_id": active["snapshot_id"],
+        "manifest": active["manifest"],
+        "sections": active["sections"],
+        "load_seconds": active["load_seconds"],
+        "previous": _history[-1] if _history else None,
+    }
+
+
+def activate_snapshot(snapshot_id: Optional[str] = None, publish: bool = False) -> Dict[str, Any]:
+    """Load ``snapshot_id`` (default: the one CURRENT points at) and switch serving to it.
+
+    The new snapshot is fully loaded and warmed before the swap; if loading
+    fails the old one keeps serving. With ``publish`` the choice is also
+    written to CURRENT so it survives restarts.
+    """
+    with _swap_lock:
+        target = snapshot_id or snapshots.read_current() or snapshots.LEGACY_SNAPSHOT_ID
+        if _active is not None and _active["snapshot_id"] == target:
+            return active_snapshot()
+        loaded = _load(target)
+        if publish:
+            snapshots.publish_current(target)
+        if _active is not None:
+            _history.append(_active["snapshot_id"])
+        _serve(loaded)
+    return active_snapshot()
+
+
+def rollback_snapshot(publish: bool = True) -> Dict[str, Any]:
+    """Switch back to the snapshot that was served before the current one."""
+    with _swap_lock:
+        if not _history:
+            raise snapshots.SnapshotError("No previous snapshot to roll back to")
+        target = _history[-1]
+        loaded = _load(target)
+        if publish:
+            snapshots.publish_current(target)
+        _history.pop()
+        _serve(loaded)
+    return active_snapshot()
+
+
+def preload() -> int:
+    """Open and warm the served snapshot. Returns the number of indexed sections."""
+    get_collection()
+    return _active["sections"]
+
+
+def active_collection() -> Tuple[str, Any]:
+    """The served ``(snapshot_id, collection)``, read from one consistent reference."""
+    get_collection()
+    active = _active
+    return active["snapshot_id"], active["collection"]
+
+
+def record_watch_update(snapshot_id: str, collection, corpus_hash: str, files_changed: int) -> Dict[str, Any]:
+    """Record in the manifest that the docs watcher edited ``snapshot_id`` in place.
+
+    Watch mode is the one writer that breaks snapshot immutability, so the
+    manifest says so (``modified_by_watch``) and its ``sections`` and
+    ``corpus_hash`` follow the index; ``ingest_corpus_hash`` keeps the hash
+    the snapshot was originally built from.
+    """
+    sections = collection.count()
+    with _swap_lock:
+        active = _active if _active is not None and _active["snapshot_id"] == snapshot_id else None
+        manifest = dict(active["manifest"] if active is not None else snapshots.read_manifest(snapshot_id))
+        manifest.setdefault("ingest_corpus_hash", manifest.get("corpus_hash"))
+        manifest["modified_by_watch"] = True
+        manifest["modified_at"] = time.time()
+        manifest["watch_files_changed"] = manifest.get("watch_files_changed", 0) + files_changed
+        manifest["sections"] = sections
+        manifest["corpus_hash"] = corpus_hash
+        if snapshot_id != snapshots.LEGACY_SNAPSHOT_ID:  # the legacy store has no manifest file
+            snapshots.write_manifest(snapshot_id, manifest)
+        if active is not None:
+            active["manifest"] = manifest
+            active["sections"] = sections
+            index_sections.set(sections)
+    return manifest
+
+
+def upsert_docs(docs: List[Dict[str, Any]], collection=None) -> None:
+    col = collection if collection is not None else get_collection()
     col.upsert(
         ids=[d["id"] for d in docs],
         documents=[d["text"] for d in docs],
@@ -36,22 +271,135 @@ def upsert_docs(docs: List[Dict[str, Any]]) -> None:
     )
 
 
-def query(text: str, n_results: int = 4, where: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+def version_flag(version: str) -> str:
+    """Metadata key marking a record as covering ``version`` (set on shared near-duplicates)."""
+    return "in_v" + re.sub(r"[^0-9a-zA-Z]", "_", version)
+
+
+def alias_key(doc_id: str) -> str:
+    """Metadata key marking a shared record as standing in for file ``doc_id``.
+
+    The same information is in the ``aliases`` JSON, but only a plain key can
+    be used in a ``where`` filter (the docs watcher looks records up by it).
+    """
+    return "alias_" + doc_id
+
+
+def version_where(version: str) -> Dict[str, Any]:
+    """Filter for records of ``version``, including shared near-duplicates from other versions."""
+    return {"$or": [{"version": version}, {version_flag(version): True}]}
+
+
+def localize_hit(hit: Dict[str, Any], version: Optional[str]) -> Dict[str, Any]:
+    """Present a shared record as the copy for ``version``.
+
+    Source, ids and version come from that version's alias, and so does the
+    text: near-duplicates can still differ in details (a version number, a
+    default), so citations, coverage checks and prompts must see the
+    requested version's own wording.
+    """
+    meta = hit.get("meta") or {}
+    if not version or meta.get("version") == version or not meta.get("aliases"):
+        return hit
+    try:
+        alias = json.loads(meta["aliases"]).get(version)
+    except (TypeError, ValueError):
+        return hit
+    if not alias:
+        return hit
+    alias = dict(alias)
+    text = alias.pop("text", None)
+    return {**hit, "text": text if text is not None else hit.get("text"), "meta": {**meta, **alias, "version": version}}
+
+
+def _embed_query(text: str, deadline: Optional[Deadline]) -> List[float]:
+    embed = get_embedding()
+    if deadline is None:
+        return embed.embed([text])[0]
+    deadline.check("embedding")
+    cap = getattr(embed, "timeout_sec", None)
+    timeout = deadline.timeout(cap) if cap is not None else None
+    try:
+        return embed.embed([text], timeout_sec=timeout)[0]
+    except Exception:
+        if deadline.expired():
+            raise DeadlineExceeded("embedding")
+        raise
+
+
+def query(
+    text: str,
+    n_results: int = 4,
+    where: Optional[Dict[str, Any]] = None,
+    deadline: Optional[Deadline] = None,
+) -> List[Dict[str, Any]]:
+    # Embed the query ourselves (rather than passing query_texts) so the
+    # embedding call only gets the time left on the request deadline.
+    embedding = _embed_query(text, deadline)
     col = get_collection()
+    if deadline is not None:
+        deadline.check("retrieval")
     res = col.query(
-        query_texts=[text],
+        query_embeddings=[embedding],
         n_results=n_results,
         include=["documents", "metadatas", "distances"],
         where=where,
     )
-    out: List[Dict[str, Any]] = []
-    for i in range(len(res["ids"][0])):
-        out.append(
-            {
-                "id": res["ids"][0][i],
-                "text": res["documents"][0][i],
-                "meta": res["metadatas"][0][i],
-                "distance": res["distances"][0][i],
-            }
-        )
-    return out
+    return _hits(res, 0)
+
+
+def _hits(res: Dict[str, Any], i: int) -> List[Dict[str, Any]]:
+    """Hits of the ``i``-th query in a Chroma query result."""
+    return [
+        {
+            "id": res["ids"][i][j],
+            "text": res["documents"][i][j],
+            "meta": res["metadatas"][i][j],
+            "distance": res["distances"][i][j],
+        }
+        for j in range(len(res["ids"][i]))
+    ]
+
+
+def query_many(texts: List[str], n_results: int = 4, where: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+    """Batch form of ``query`` (no deadline): one embedding call and one Chroma query for all ``texts``."""
+    if not texts:
+        return []
+    embeddings = get_embedding().embed(texts)
+    res = get_collection().query(
+        query_embeddings=embeddings,
+        n_results=n_results,
+        include=["documents", "metadatas", "distances"],
+        where=where,
+    )
+    return [_hits(res, i) for i in range(len(texts))]
+
+
+def retrieve(
+    text: str,
+    n_results: int,
+    version: str,
+    deadline: Optional[Deadline] = None,
+    dedupe: bool = True,
+) -> List[Dict[str, Any]]:
+    """Top hits for ``version``: shared records shown as that version's copy, near-duplicates dropped.
+
+    With ``dedupe`` the query over-fetches (``DEDUP_OVERFETCH``) so up to
+    ``n_results`` distinct hits are still returned.
+    """
+    fetch = n_results * DEDUP_OVERFETCH if dedupe else n_results
+    hits = query(text, n_results=fetch, where=version_where(version), deadline=deadline)
+    hits = [localize_hit(h, version) for h in hits]
+    if dedupe:
+        kept = dedupe_hits(hits, n_results)
+        # Count only the duplicates that would otherwise have taken a slot.
+        scanned = next(i for i, h in enumerate(hits) if h is kept[-1]) + 1 if kept else 0
+        if scanned > len(kept):
+            duplicate_hits_dropped_total.inc(scanned - len(kept))
+        hits = kept
+    return hits
+
+
+def dedupe_hits(hits: List[Dict[str, Any]], n_results: int) -> List[Dict[str, Any]]:
+    """The first ``n_results`` hits once near-duplicates are dropped (see ``retrieve``)."""
+    return drop_near_duplicate_hits(hits)[:n_results]
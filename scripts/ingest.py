@@ -1,77 +1,225 @@
 from __future__ import annotations
 
+import argparse
 import glob
 import hashlib
+import io
+import itertools
+import json
 import os
 import re
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-from app.store import upsert_docs
+from app import snapshots
+from app.context import estimate_tokens
+from app.dedup import near_duplicate_clusters
+from app.embeddings import describe_embedding_function
+from app.store import COLLECTION_NAME, alias_key, get_embedding, open_collection, upsert_docs, version_flag
 
 DOCS_GLOB = os.getenv("DOCS_GLOB", "data/docs/**/*.md")
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "512"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "64"))
+DEDUP_NEAR_DUPLICATES = os.getenv("DEDUP_NEAR_DUPLICATES", "1").lower() not in {"0", "false", "no"}
 
 
 _VERSION_RE = re.compile(r"v(\d+\.\d+)")
 _HEADING_RE = re.compile(r"^(#{1,6})\s+(.+)$")
 _FENCE_RE = re.compile(r"^(```|~~~)")
+# detect_version only looks for a "(vX.Y)" title this close to the top of a file.
+_VERSION_HEAD_LINES = 10
 
 
-def split_markdown_sections(md: str):
-    lines = md.splitlines()
-    sections = []
-    stack = []
-    current_heading = None
-    current_lines = []
-    in_code_block = False
+class _SectionChunker:
+    """Accumulates one section's lines and cuts them into size-bounded chunks.
 
-    def heading_path() -> str:
-        if not stack:
-            return "Document"
-        return " > ".join([h for _, h in stack])
+    Lines are grouped into blocks (paragraphs separated by blank lines, or a
+    whole fenced code block). Blocks are packed into chunks of at most
+    ``max_tokens``; a new chunk starts with the trailing blocks of the previous
+    one, up to ``overlap_tokens``. A single block larger than a chunk is split
+    on line boundaries, re-opening the code fence in every piece.
+    """
 
-    def flush_section():
-        body = "\n".join(current_lines).strip()
-        if not body:
+    def __init__(self, max_tokens: int, overlap_tokens: int):
+        self.max_tokens = max(max_tokens, 1)
+        self.overlap_tokens = max(min(overlap_tokens, self.max_tokens // 2), 0)
+        self.block_lines: List[str] = []
+        self.in_code_block = False
+        # (separator before the block, block text); the separator keeps the
+        # original spacing when a fence directly follows a paragraph.
+        self.blocks: List[Tuple[str, str]] = []
+        self.gap = "\n\n"
+        self.tokens = 0
+        self.fresh = 0  # blocks in the current chunk that are not overlap
+        self.chunks: List[str] = []
+
+    def add_line(self, line: str) -> None:
+        if _FENCE_RE.match(line.strip()):
+            if not self.in_code_block:
+                self._end_block()
+                self.block_lines.append(line)
+                self.in_code_block = True
+            else:
+                self.block_lines.append(line)
+                self.in_code_block = False
+                self._end_block()
+            return
+        if not self.in_code_block and not line.strip():
+            self._end_block()
+            self.gap = "\n\n"
+            return
+        self.block_lines.append(line)
+
+    def finish(self) -> List[str]:
+        self._end_block()
+        self._emit()
+        return self.take()
+
+    def take(self) -> List[str]:
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+    def _end_block(self) -> None:
+        if not self.block_lines:
             return
+        block = "\n".join(self.block_lines).strip("\n")
+        self.block_lines = []
+        if not block.strip():
+            return
+        cost = estimate_tokens(block)
+        if cost > self.max_tokens:
+            self._emit()
+            self.blocks, self.tokens = [], 0
+            self.chunks.extend(self._split_block(block))
+            self.gap = "\n"
+            return
+        if self.fresh and self.tokens + cost > self.max_tokens:
+            self._emit()
+            self._start_with_overlap()
+            if self.tokens + cost > self.max_tokens:
+                self.blocks, self.tokens = [], 0
+        self.blocks.append((self.gap, block))
+        self.gap = "\n"
+        self.tokens += cost
+        self.fresh += 1
+
+    def _emit(self) -> None:
+        if self.fresh:
+            self.chunks.append(self.blocks[0][1] + "".join(gap + block for gap, block in self.blocks[1:]))
+        self.fresh = 0
+
+    def _start_with_overlap(self) -> None:
+        keep: List[Tuple[str, str]] = []
+        tokens = 0
+        for gap, block in reversed(self.blocks):
+            cost = estimate_tokens(block)
+            if tokens + cost > self.overlap_tokens:
+                break
+            keep.insert(0, (gap, block))
+            tokens += cost
+        self.blocks, self.tokens = keep, tokens
+
+    def _split_block(self, block: str) -> List[str]:
+        lines = block.split("\n")
+        opener = closer = ""
+        if len(lines) > 1 and _FENCE_RE.match(lines[0].strip()) and _FENCE_RE.match(lines[-1].strip()):
+            opener, closer = lines[0], lines[-1]
+            lines = lines[1:-1]
+        budget = max(self.max_tokens - estimate_tokens(opener) - estimate_tokens(closer) - 1, 1)
+        max_chars = budget * 4
+        pieces: List[str] = []
+        current: List[str] = []
+        tokens = 0
+        for line in lines:
+            # A single line longer than a chunk (minified JSON, huge table row) is hard-split.
+            while len(line) > max_chars:
+                if current:
+                    pieces.append("\n".join(current))
+                    current, tokens = [], 0
+                pieces.append(line[:max_chars])
+                line = line[max_chars:]
+            cost = estimate_tokens(line) + 1
+            if current and tokens + cost > budget:
+                pieces.append("\n".join(current))
+                current, tokens = [], 0
+            current.append(line)
+            tokens += cost
+        if current:
+            pieces.append("\n".join(current))
+        if opener:
+            pieces = [f"{opener}\n{piece}\n{closer}" for piece in pieces]
+        return pieces
+
+
+def iter_markdown_sections(
+    lines: Iterable[str],
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+) -> Iterator[Dict[str, Any]]:
+    """Stream heading-scoped, size-bounded chunks from Markdown ``lines``.
+
+    Each chunk carries the heading it belongs to, the full ``heading_path``
+    and a per-section ``chunk`` ordinal, so chunks still roll up per heading.
+    Only the section currently being read is held in memory.
+    """
+    stack: List[Tuple[int, str]] = []
+    current_heading: Optional[str] = None
+    chunker = _SectionChunker(max_tokens, overlap_tokens)
+    ordinal = 0
+
+    def section_chunks(texts: List[str]) -> Iterator[Dict[str, Any]]:
+        nonlocal ordinal
         if current_heading:
-            path = heading_path()
-            sections.append({"heading": current_heading, "heading_path": path, "text": body})
+            heading, path = current_heading, " > ".join([h for _, h in stack])
         else:
-            sections.append({"heading": "Preface", "heading_path": "Preface", "text": body})
+            heading, path = "Preface", "Preface"
+        for text in texts:
+            yield {"heading": heading, "heading_path": path, "text": text, "chunk": ordinal}
+            ordinal += 1
 
     for line in lines:
-        if _FENCE_RE.match(line.strip()):
-            in_code_block = not in_code_block
-            current_lines.append(line)
-            continue
-
-        if not in_code_block:
+        line = line.rstrip("\r\n")
+        if not chunker.in_code_block and not _FENCE_RE.match(line.strip()):
             m = _HEADING_RE.match(line)
             if m:
-                flush_section()
+                yield from section_chunks(chunker.finish())
                 level = len(m.group(1))
                 title = m.group(2).strip()
                 while stack and stack[-1][0] >= level:
                     stack.pop()
                 stack.append((level, title))
                 current_heading = title
-                current_lines = []
+                chunker = _SectionChunker(max_tokens, overlap_tokens)
+                ordinal = 0
                 continue
 
-        current_lines.append(line)
+        chunker.add_line(line)
+        yield from section_chunks(chunker.take())
+
+    yield from section_chunks(chunker.finish())
 
-    flush_section()
 
+def split_markdown_sections(
+    md: Union[str, Iterable[str]],
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+) -> List[Dict[str, Any]]:
+    lines = io.StringIO(md) if isinstance(md, str) else md
+    sections = list(iter_markdown_sections(lines, max_tokens, overlap_tokens))
     if not sections:
-        return [{"heading": "Document", "heading_path": "Document", "text": md}]
+        text = md if isinstance(md, str) else ""
+        return [{"heading": "Document", "heading_path": "Document", "text": text, "chunk": 0}]
     return sections
 
 
-def detect_version(path: str, text: str) -> str:
+def detect_version(path: str, head: Iterable[str]) -> str:
+    """Version from the path (``/v1.1/``) or the first heading in ``head`` lines."""
     normalized = path.replace(os.sep, "/").lower()
     m = re.search(r"/v(\d+\.\d+)/", normalized)
     if m:
         return m.group(1)
-    for line in text.splitlines()[:10]:
+    for line in itertools.islice(head, _VERSION_HEAD_LINES):
         line = line.strip()
         if line.startswith("#"):
             m = re.search(r"\(v(\d+\.\d+)\)", line.lower())
@@ -91,40 +239,195 @@ def make_section_id(doc_id: str, heading_path: str) -> str:
     return hashlib.sha1(key).hexdigest()
 
 
-def main() -> None:
-    paths = sorted(glob.glob(DOCS_GLOB, recursive=True))
-    if not paths:
-        raise SystemExit(f"No docs found for glob: {DOCS_GLOB}")
+def make_chunk_id(section_id: str, chunk: int) -> str:
+    return f"{section_id}:{chunk}"
 
-    docs = []
-    for p in paths:
-        with open(p, "r", encoding="utf-8") as f:
-            text = f.read().strip()
 
-        doc_id = make_doc_id(p)
-        version = detect_version(p, text)
-        for section in split_markdown_sections(text):
+def _hashed_lines(lines: Iterable[str], digest: Optional[Any]) -> Iterator[str]:
+    for line in lines:
+        if digest is not None:
+            digest.update(line.encode("utf-8"))
+        yield line
+
+
+def build_file_docs(path: str, digest: Optional[Any] = None) -> List[Dict[str, Any]]:
+    """Index records (id, text, meta) for every chunk of one Markdown file.
+
+    The file is streamed through ``iter_markdown_sections`` and never read
+    whole. If ``digest`` (a hashlib object) is given, the file content is fed
+    to it on the way through.
+    """
+    doc_id = make_doc_id(path)
+    docs = []
+    # Ordinals run per heading path across the file, so repeated headings
+    # (e.g. two "Examples" under the same parent) still get distinct ids.
+    ordinals: Counter[str] = Counter()
+    with open(path, "r", encoding="utf-8") as f:
+        lines = _hashed_lines(f, digest)
+        head = list(itertools.islice(lines, _VERSION_HEAD_LINES))
+        version = detect_version(path, head)
+        for section in iter_markdown_sections(itertools.chain(head, lines)):
             heading = section["heading"]
             heading_path = section["heading_path"]
             section_id = make_section_id(doc_id, heading_path)
+            chunk = ordinals[heading_path]
+            ordinals[heading_path] += 1
             docs.append(
                 {
-                    "id": section_id,
+                    "id": make_chunk_id(section_id, chunk),
                     "text": f"Section: {heading_path}\n\n{section['text']}",
                     "meta": {
-                        "source": p,
+                        "source": path,
                         "version": version,
-                        "title": os.path.basename(p),
+                        "title": os.path.basename(path),
                         "heading": heading,
                         "doc_id": doc_id,
                         "section_id": section_id,
                         "heading_path": heading_path,
+                        "chunk": chunk,
                     },
                 }
             )
+    return docs
+
+
+def _version_key(version: str) -> Tuple[int, ...]:
+    try:
+        return tuple(int(part) for part in version.split("."))
+    except ValueError:
+        return ()
+
+
+_ALIAS_KEYS = ("source", "title", "heading", "heading_path", "doc_id", "section_id", "chunk")
+
+
+def collapse_near_duplicates(docs: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Store one embedding per cluster of near-identical chunks from different versions.
+
+    The copy from the newest version is kept. It is flagged as covering the
+    other versions (``version_flag``) and carries their source, ids and own
+    text in ``aliases`` (plus a filterable ``alias_key`` per folded file), so
+    retrieval cites and shows the requested version's copy. Only one copy per other version is folded in; copies from the same
+    version (as the kept one or as each other) stay separate records, since
+    the version flag could not tell them apart. Returns the records to index
+    and a report of the clusters.
+    """
+    drop = set()
+    report = []
+    for cluster in near_duplicate_clusters([d["text"] for d in docs]):
+        keep = max(cluster, key=lambda i: (_version_key(docs[i]["meta"]["version"]), docs[i]["id"]))
+        meta = docs[keep]["meta"]
+        aliases: Dict[str, Dict[str, Any]] = {}
+        folded = []
+        for i in cluster:
+            other = docs[i]["meta"]
+            if i == keep or other["version"] == meta["version"] or other["version"] in aliases:
+                continue
+            aliases[other["version"]] = {**{k: other[k] for k in _ALIAS_KEYS}, "text": docs[i]["text"]}
+            folded.append(i)
+        if not aliases:
+            continue
+        drop.update(folded)
+        for version, alias in aliases.items():
+            meta[version_flag(version)] = True
+            meta[alias_key(alias["doc_id"])] = True
+        meta["aliases"] = json.dumps(aliases, sort_keys=True)
+        meta["versions"] = ",".join(sorted({meta["version"], *aliases}, key=_version_key))
+        meta["duplicates"] = len(aliases)
+        report.append(
+            {
+                "kept": f"{meta['source']} > {meta['heading_path']}",
+                "dropped": [f"{docs[i]['meta']['source']} > {docs[i]['meta']['heading_path']}" for i in folded],
+            }
+        )
+    return [d for i, d in enumerate(docs) if i not in drop], report
+
+
+def file_digest_entry(path: str, file_digest: Any) -> bytes:
+    """One file's contribution to ``corpus_hash``: relative path + content hash."""
+    return os.path.relpath(path).encode("utf-8") + b"\0" + file_digest.digest()
+
+
+def corpus_hash(paths: Iterable[str]) -> str:
+    """Hash of (relative path, content) for every file; matches what ``main`` records."""
+    h = hashlib.sha256()
+    for path in paths:
+        file_digest = hashlib.sha256()
+        with open(path, "r", encoding="utf-8") as f:
+            for _ in _hashed_lines(f, file_digest):
+                pass
+        h.update(file_digest_entry(path, file_digest))
+    return h.hexdigest()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Ingest docs into a new, immutable index snapshot.")
+    parser.add_argument(
+        "--no-publish",
+        action="store_true",
+        help="Build the snapshot but do not point CURRENT at it (activate later via /admin/snapshots/activate).",
+    )
+    parser.add_argument("--dedup-report", action="store_true", help="Print every near-duplicate cluster.")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(DOCS_GLOB, recursive=True))
+    if not paths:
+        raise SystemExit(f"No docs found for glob: {DOCS_GLOB}")
+
+    # Files are streamed one at a time; the corpus hash is built from each
+    # file's content hash as it is read, so no file text is kept around.
+    docs = []
+    corpus = hashlib.sha256()
+    for p in paths:
+        file_digest = hashlib.sha256()
+        docs.extend(build_file_docs(p, digest=file_digest))
+        corpus.update(file_digest_entry(p, file_digest))
+
+    chunks = len(docs)
+    clusters: List[Dict[str, Any]] = []
+    if DEDUP_NEAR_DUPLICATES:
+        docs, clusters = collapse_near_duplicates(docs)
+        if args.dedup_report:
+            for cluster in clusters:
+                print(f"[dedup] kept {cluster['kept']}")
+                for dropped in cluster["dropped"]:
+                    print(f"[dedup]   dropped {dropped}")
+
+    digest = corpus.hexdigest()
+    snapshot_id = snapshots.new_snapshot_id(digest)
+    if os.path.exists(snapshots.snapshot_path(snapshot_id)):
+        raise SystemExit(f"Snapshot {snapshot_id} already exists; snapshots are immutable")
+    col = open_collection(snapshots.snapshot_path(snapshot_id))
+    upsert_docs(docs, collection=col)
 
-    upsert_docs(docs)
-    print(f"Ingested {len(docs)} sections into Chroma.")
+    embedding = describe_embedding_function(get_embedding())
+    sample = col.get(limit=1, include=["embeddings"])
+    if sample["embeddings"] is not None and len(sample["embeddings"]):
+        embedding["dim"] = len(sample["embeddings"][0])
+    # The manifest is written last: a snapshot without one is treated as incomplete.
+    snapshots.write_manifest(
+        snapshot_id,
+        {
+            "snapshot_id": snapshot_id,
+            "created_at": time.time(),
+            "corpus_hash": digest,
+            "docs_glob": DOCS_GLOB,
+            "files": len(paths),
+            "sections": len(docs),
+            "collection": COLLECTION_NAME,
+            "embedding": embedding,
+            "dedup": {
+                "enabled": DEDUP_NEAR_DUPLICATES,
+                "clusters": len(clusters),
+                "embeddings_saved": chunks - len(docs),
+            },
+        },
+    )
+    if not args.no_publish:
+        snapshots.publish_current(snapshot_id)
+    print(f"Ingested {len(docs)} sections into snapshot {snapshot_id}.")
+    if DEDUP_NEAR_DUPLICATES:
+        print(f"Near-duplicates: {len(clusters)} clusters, {chunks - len(docs)} embeddings saved.")
 
 
 if __name__ == "__main__":
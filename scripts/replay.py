@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from app.rules import (
+    MAX_AVG_DISTANCE,
+    MAX_TOP_DISTANCE,
+    MIN_CITATIONS,
+    evidence_features,
+    issues_from_features,
+)
+
+TOP_K = int(os.getenv("TOP_K", "4"))
+ISSUE_TYPES = (
+    "unanswered",
+    "weak_evidence",
+    "low_relevance",
+    "low_coverage",
+    "version_conflict",
+    "unsupported_feature",
+)
+
+# (top_k, min_citations, max_top_distance, max_avg_distance)
+Setting = Tuple[int, int, float, float]
+# (query, requested_version)
+QueryKey = Tuple[str, str]
+
+_grid: List[Setting] = []
+
+
+def read_queries(path: str) -> Tuple[Counter, int]:
+    """Count logged (query, requested_version) pairs from query_result events.
+
+    Policy refusals never reached retrieval and are skipped. Repeated queries
+    are counted, not stored, so millions of events fit in memory.
+    """
+    counts: Counter = Counter()
+    events = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            # Cheap pre-filter before paying for json.loads on every line.
+            if '"query_result"' not in line:
+                continue
+            try:
+                evt = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if evt.get("type") != "query_result" or evt.get("answer_mode") == "refused":
+                continue
+            query = (evt.get("query") or "").strip()
+            version = evt.get("requested_version")
+            if not query or not version:
+                continue
+            counts[(query, version)] += 1
+            events += 1
+    return counts, events
+
+
+def _init_worker(grid: List[Setting]) -> None:
+    global _grid
+    _grid = grid
+    from app import store
+
+    store.get_collection()
+
+
+def _replay_chunk(chunk: Sequence[Tuple[QueryKey, int]]) -> Tuple[Dict[Setting, Counter], Dict[Setting, int]]:
+    """Retrieve once per query at the largest top_k and classify it under every setting.
+
+    Queries are grouped by version so each group costs one batched embedding
+    call and one Chroma query, instead of a round trip per query.
+    """
+    from app import store
+
+    max_k = max(s[0] for s in _grid)
+    by_k: Dict[int, List[Setting]] = defaultdict(list)
+    for setting in _grid:
+        by_k[setting[0]].append(setting)
+    by_version: Dict[str, List[Tuple[str, int]]] = defaultdict(list)
+    for (query, version), weight in chunk:
+        by_version[version].append((query, weight))
+
+    issues: Dict[Setting, Counter] = defaultdict(Counter)
+    totals: Dict[Setting, int] = defaultdict(int)
+    for version, group in by_version.items():
+        results = store.query_many(
+            [q for q, _ in group], n_results=max_k * store.DEDUP_OVERFETCH, where=store.version_where(version)
+        )
+        for (query, weight), hits in zip(group, results):
+            raw = [store.localize_hit(h, version) for h in hits]
+            for k, settings in by_k.items():
+                # Chroma ranks by distance, so what /ask fetches for TOP_K=k is a
+                # prefix of this; dedupe and cut it the same way retrieve() does.
+                features = evidence_features(query, store.dedupe_hits(raw[: k * store.DEDUP_OVERFETCH], k), version)
+                for setting in settings:
+                    _, min_citations, max_top, max_avg = setting
+                    totals[setting] += weight
+                    found = issues_from_features(features, min_citations, max_top, max_avg)
+                    for issue_type in found:
+                        issues[setting][issue_type] += weight
+                    if found:
+                        issues[setting]["any"] += weight
+    return dict(issues), dict(totals)
+
+
+def _chunks(items: Sequence[Tuple[QueryKey, int]], size: int) -> Iterator[List[Tuple[QueryKey, int]]]:
+    it = iter(items)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _parse_list(value: str, cast) -> List:
+    return [cast(v) for v in value.split(",") if v.strip()]
+
+
+def _rows(issues: Dict[Setting, Counter], totals: Dict[Setting, int], grid: List[Setting]) -> List[Dict[str, object]]:
+    rows = []
+    for setting in grid:
+        total = totals.get(setting, 0)
+        row: Dict[str, object] = {
+            "top_k": setting[0],
+            "min_citations": setting[1],
+            "max_top_distance": setting[2],
+            "max_avg_distance": setting[3],
+            "queries": total,
+        }
+        for issue_type in ("any",) + ISSUE_TYPES:
+            count = issues.get(setting, Counter())[issue_type]
+            row[f"{issue_type}_rate"] = round(count / total, 4) if total else 0.0
+        rows.append(row)
+    return rows
+
+
+def _print_table(rows: List[Dict[str, object]]) -> None:
+    if not rows:
+        return
+    headers = list(rows[0].keys())
+    widths = {h: max(len(h), *(len(str(r[h])) for r in rows)) for h in headers}
+    print("  ".join(h.rjust(widths[h]) for h in headers))
+    for row in rows:
+        print("  ".join(str(row[h]).rjust(widths[h]) for h in headers))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from app.logger import LOG_FILE
+
+    parser = argparse.ArgumentParser(
+        description="Replay logged queries through retrieval + issue classification for a grid of thresholds."
+    )
+    parser.add_argument("--log-file", default=LOG_FILE)
+    parser.add_argument("--top-k", default=str(TOP_K), help="Comma-separated values, e.g. 3,4,6")
+    parser.add_argument("--min-citations", default=str(MIN_CITATIONS))
+    parser.add_argument("--max-top-distance", default=str(MAX_TOP_DISTANCE))
+    parser.add_argument("--max-avg-distance", default=str(MAX_AVG_DISTANCE))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=256, help="Unique queries per worker task.")
+    parser.add_argument("--csv", help="Also write the per-setting table to this CSV file.")
+    args = parser.parse_args(argv)
+
+    grid: List[Setting] = list(
+        itertools.product(
+            _parse_list(args.top_k, int),
+            _parse_list(args.min_citations, int),
+            _parse_list(args.max_top_distance, float),
+            _parse_list(args.max_avg_distance, float),
+        )
+    )
+    if not grid:
+        raise SystemExit("Empty threshold grid")
+    if not os.path.exists(args.log_file):
+        raise SystemExit(f"No event log at {args.log_file}")
+
+    start = time.perf_counter()
+    counts, events = read_queries(args.log_file)
+    read_elapsed = time.perf_counter() - start
+    items = sorted(counts.items())
+    print(
+        f"Read {events} query events ({len(items)} unique) in {read_elapsed:.1f}s; "
+        f"{len(grid)} settings, {args.workers} workers",
+        file=sys.stderr,
+    )
+
+    issues: Dict[Setting, Counter] = defaultdict(Counter)
+    totals: Dict[Setting, int] = defaultdict(int)
+    replay_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(args.workers, 1), initializer=_init_worker, initargs=(grid,)) as pool:
+        for chunk_issues, chunk_totals in pool.map(_replay_chunk, _chunks(items, max(args.chunk_size, 1))):
+            for setting, counter in chunk_issues.items():
+                issues[setting].update(counter)
+            for setting, total in chunk_totals.items():
+                totals[setting] += total
+    replay_elapsed = max(time.perf_counter() - replay_start, 1e-9)
+
+    rows = _rows(issues, totals, grid)
+    _print_table(rows)
+    if args.csv:
+        with open(args.csv, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    print(
+        f"Replayed {len(items)} unique queries ({events} events) in {replay_elapsed:.1f}s: "
+        f"{len(items) / replay_elapsed:.0f} retrievals/s, "
+        f"{events / replay_elapsed:.0f} events/s, "
+        f"{len(items) * len(grid) / replay_elapsed:.0f} classifications/s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
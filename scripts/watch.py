@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from app.metrics import ingest_files_total, ingest_file_seconds, ingest_lag_seconds
+from app.store import alias_key, version_flag
+from scripts.ingest import DOCS_GLOB, build_file_docs, corpus_hash, make_doc_id
+
+INGEST_WATCH_INTERVAL_SEC = float(os.getenv("INGEST_WATCH_INTERVAL_SEC", "1"))
+INGEST_DEBOUNCE_SEC = float(os.getenv("INGEST_DEBOUNCE_SEC", "0.5"))
+
+FileState = Tuple[int, int]  # (mtime_ns, size)
+
+
+def _scan(docs_glob: str) -> Dict[str, FileState]:
+    out: Dict[str, FileState] = {}
+    for path in glob.glob(docs_glob, recursive=True):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        out[path] = (st.st_mtime_ns, st.st_size)
+    return out
+
+
+class DocsWatcher:
+    """Re-index Markdown files under ``docs_glob`` as they change.
+
+    Polls file mtimes/sizes (no extra dependencies), waits until a burst of
+    edits has been quiet for ``debounce_sec``, then re-splits only the
+    affected files and upserts/deletes only their sections. The target
+    ``(snapshot_id, collection)`` is resolved per batch so writes follow
+    snapshot swaps. After each batch ``on_batch(snapshot_id, collection,
+    corpus_hash, files_changed)`` is called so the edited snapshot's manifest
+    can record it (see ``app.store.record_watch_update``).
+    """
+
+    def __init__(
+        self,
+        get_target: Callable[[], Tuple[str, Any]],
+        docs_glob: str = DOCS_GLOB,
+        interval_sec: float = INGEST_WATCH_INTERVAL_SEC,
+        debounce_sec: float = INGEST_DEBOUNCE_SEC,
+        on_batch: Optional[Callable[[str, Any, str, int], Any]] = None,
+    ):
+        self.get_target = get_target
+        self.on_batch = on_batch
+        self.docs_glob = docs_glob
+        self.interval_sec = interval_sec
+        self.debounce_sec = debounce_sec
+        # Baseline: files present at startup are assumed to be indexed already.
+        self._known = _scan(docs_glob)
+        # path -> when the change happened (mtime, or detection time for removals)
+        self._pending: Dict[str, float] = {}
+        self._last_change = 0.0
+        self._last_scan = time.time()
+
+    def poll_once(self) -> int:
+        """Detect changes and process them once the burst has settled. Returns files processed."""
+        now = time.time()
+        current = _scan(self.docs_glob)
+        for path, state in current.items():
+            if self._known.get(path) != state:
+                # Copied files can keep an old mtime; never date a change before the previous scan.
+                self._pending.setdefault(path, max(state[0] / 1e9, self._last_scan))
+                self._last_change = now
+        for path in self._known.keys() - current.keys():
+            self._pending.setdefault(path, now)
+            self._last_change = now
+        self._known = current
+        self._last_scan = now
+
+        if not self._pending or now - self._last_change < self.debounce_sec:
+            return 0
+        snapshot_id, col = self.get_target()
+        processed = 0
+        try:
+            for path in sorted(self._pending):
+                self._process(col, path, self._pending[path])
+                # Only drop a file once it is indexed, so a failure is retried on the next poll.
+                del self._pending[path]
+                processed += 1
+        finally:
+            if processed and self.on_batch is not None:
+                paths = sorted(glob.glob(self.docs_glob, recursive=True))
+                self.on_batch(snapshot_id, col, corpus_hash(paths), processed)
+        return processed
+
+    def _unshare(self, col, ids, metadatas, path: str, doc_id: Optional[str] = None) -> None:
+        """Stop shared records from standing in for other versions' files.
+
+        Near-duplicate records (see ingest.collapse_near_duplicates) cover
+        other files through version flags, ``alias_key`` keys and the
+        ``aliases`` JSON. With ``doc_id`` only that file's alias is removed;
+        otherwise all of them are, and those files are queued to be indexed
+        on their own. Chroma merges metadata on update and cannot delete keys,
+        so flags are set to False rather than removed.
+        """
+        update_ids, patches = [], []
+        for record_id, meta in zip(ids, metadatas or []):
+            if not meta or not meta.get("aliases"):
+                continue
+            aliases = json.loads(meta["aliases"])
+            removed = {v: a for v, a in aliases.items() if doc_id is None or a.get("doc_id") == doc_id}
+            if not removed:
+                continue
+            patch: Dict[str, Any] = {}
+            for version, alias in removed.items():
+                patch[version_flag(version)] = False
+                patch[alias_key(alias["doc_id"])] = False
+                if alias.get("source") and alias["source"] != path:
+                    self._pending.setdefault(alias["source"], time.time())
+            left = {v: a for v, a in aliases.items() if v not in removed}
+            patch["aliases"] = json.dumps(left, sort_keys=True)
+            patch["versions"] = ",".join(v for v in (meta.get("versions") or "").split(",") if v and v not in removed)
+            patch["duplicates"] = len(left)
+            update_ids.append(record_id)
+            patches.append(patch)
+        if update_ids:
+            col.update(ids=update_ids, metadatas=patches)
+
+    def _process(self, col, path: str, changed_at: float) -> None:
+        start = time.perf_counter()
+        doc_id = make_doc_id(path)
+        res = col.get(where={"doc_id": doc_id}, include=["metadatas"])
+        existing = set(res["ids"])
+        # Once rewritten, this file's records no longer match the other
+        # versions' copies they stood in for; those files are re-indexed alone.
+        self._unshare(col, res["ids"], res["metadatas"], path)
+        # Records of another file that stand in for this one stop covering its
+        # version: the file is indexed on its own below, or is gone.
+        shared = col.get(where={alias_key(doc_id): True}, include=["metadatas"])
+        self._unshare(col, shared["ids"], shared["metadatas"], path, doc_id=doc_id)
+        try:
+            docs = build_file_docs(path)
+            change = "modified" if existing else "added"
+        except FileNotFoundError:
+            docs = []
+            change = "removed"
+        stale = existing - {d["id"] for d in docs}
+        if stale:
+            col.delete(ids=sorted(stale))
+        if docs:
+            col.upsert(
+                ids=[d["id"] for d in docs],
+                documents=[d["text"] for d in docs],
+                metadatas=[d["meta"] for d in docs],
+            )
+
+        ingest_file_seconds.observe(time.perf_counter() - start)
+        ingest_lag_seconds.observe(max(time.time() - changed_at, 0.0))
+        ingest_files_total.labels(change=change).inc()
+        print(f"[watch] {change} {path}: {len(docs)} sections upserted, {len(stale)} deleted")
+
+    def run(self, stop: Optional[threading.Event] = None) -> None:
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                self.poll_once()
+            except Exception as exc:  # keep watching; the next change retries
+                print(f"[watch] error: {type(exc).__name__}: {exc}")
+            stop.wait(self.interval_sec)
+
+
+def main() -> None:
+    from app import store
+
+    parser = argparse.ArgumentParser(
+        description="Watch docs and re-index changed files in place in the CURRENT snapshot."
+    )
+    parser.add_argument("--interval", type=float, default=INGEST_WATCH_INTERVAL_SEC)
+    parser.add_argument("--debounce", type=float, default=INGEST_DEBOUNCE_SEC)
+    parser.add_argument("--metrics-port", type=int, default=0, help="Expose Prometheus metrics on this port.")
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        from prometheus_client import start_http_server
+
+        start_http_server(args.metrics_port)
+
+    watcher = DocsWatcher(
+        store.active_collection,
+        interval_sec=args.interval,
+        debounce_sec=args.debounce,
+        on_batch=store.record_watch_update,
+    )
+    print(f"Watching {watcher.docs_glob}")
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()